@@ -1,15 +1,34 @@
+import hashlib
+import hmac
 import os
+import queue
 import sqlite3
+import threading
+from functools import wraps
+from itertools import chain
 from pathlib import Path
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, g, flash, jsonify
+    url_for, session, g, flash, jsonify, Response
 )
 
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / "apna_cart.db"
 
-app = Flask(__name__)
+# Product images get a one-year max-age; CSS/JS keep Flask's default since
+# their filenames aren't fingerprinted and edits must reach browsers.
+IMAGE_MAX_AGE = 31536000
+
+class ApnaCart(Flask):
+    def get_send_file_max_age(self, filename):
+        if filename and filename.startswith("img/"):
+            return IMAGE_MAX_AGE
+        return super().get_send_file_max_age(filename)
+
+app = ApnaCart(__name__)
 app.config.update(
     SECRET_KEY="change_this_secret_key",
     SESSION_COOKIE_HTTPONLY=True,
@@ -17,88 +36,143 @@ app.config.update(
 )
 
 # ---------------- DB helpers ----------------
+# Connections are opened once and reused across requests so the PRAGMAs
+# are applied a single time and each connection's page cache stays warm.
+POOL_SIZE = (os.cpu_count() or 1) + 1
+STATEMENT_CACHE_SIZE = 256
+_pool = None
+_pool_lock = threading.Lock()
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-20000;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    return conn
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = queue.Queue(maxsize=POOL_SIZE)
+                for _ in range(POOL_SIZE):
+                    pool.put(_connect())
+                _pool = pool
+    return _pool
+
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = _get_pool().get()
     return g.db
 
 @app.teardown_appcontext
 def close_db(exc):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        # Never hand a connection with an open transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        _get_pool().put(db)
 
 def column_exists(db, table, column):
     row = db.execute(
-        "PRAGMA table_info(%s)" % table
-    ).fetchall()
-    return any(col["name"] == column for col in row)
+        "SELECT 1 FROM pragma_table_info(?) WHERE name=?;", (table, column)
+    ).fetchone()
+    return row is not None
+
+SCHEMA_SQL = """
+BEGIN IMMEDIATE;
+
+-- Users
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    email TEXT UNIQUE,
+    password TEXT NOT NULL
+);
+
+-- Products ('image' may be added by migration in _create_schema)
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    price INTEGER NOT NULL
+);
+
+-- Cart
+CREATE TABLE IF NOT EXISTS cart (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 1,
+    FOREIGN KEY(user_id) REFERENCES users(id),
+    FOREIGN KEY(product_id) REFERENCES products(id),
+    UNIQUE(user_id, product_id)
+);
+
+-- Orders
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    total_amount INTEGER NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+CREATE TABLE IF NOT EXISTS order_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    price_each INTEGER NOT NULL,
+    FOREIGN KEY(order_id) REFERENCES orders(id),
+    FOREIGN KEY(product_id) REFERENCES products(id)
+);
+
+-- Indexes. cart lookups by user_id already use the prefix of the
+-- UNIQUE(user_id, product_id) autoindex, so no separate index there.
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
+"""
+
+# Schema setup runs once per process, however init_db() ends up being called.
+# _init_lock only serialises threads within one process; gunicorn workers
+# are kept from double-seeding by the BEGIN IMMEDIATE in SCHEMA_SQL, which
+# makes the table setup, product count and seed one locked transaction.
+_initialized = False
+_init_lock = threading.Lock()
 
 def init_db():
-    db = get_db()
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if not _initialized:
+            _create_schema(get_db())
+            _initialized = True
+
+def _create_schema(db):
     cur = db.cursor()
 
-    # Users
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE,
-            password TEXT NOT NULL
-        );
-    """)
-
-    # Products (create if not present)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            price INTEGER NOT NULL
-            -- 'image' may be added by migration below
-        );
-    """)
+    # WAL is persisted in the DB header, so set it once at startup
+    cur.execute("PRAGMA journal_mode=WAL;")
+
+    # All DDL in one parse. The script takes the write lock up front (BEGIN
+    # IMMEDIATE, so the busy timeout applies when several workers start at
+    # once) and leaves the transaction open so the migration and seed below
+    # land in the same commit.
+    db.executescript(SCHEMA_SQL)
 
     # Migration: ensure 'image' column exists
     if not column_exists(db, "products", "image"):
         cur.execute("ALTER TABLE products ADD COLUMN image TEXT;")
 
-    # Cart
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS cart (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            product_id INTEGER NOT NULL,
-            quantity INTEGER NOT NULL DEFAULT 1,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(product_id) REFERENCES products(id),
-            UNIQUE(user_id, product_id)
-        );
-    """)
-
-    # Orders
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            total_amount INTEGER NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS order_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER NOT NULL,
-            product_id INTEGER NOT NULL,
-            quantity INTEGER NOT NULL,
-            price_each INTEGER NOT NULL,
-            FOREIGN KEY(order_id) REFERENCES orders(id),
-            FOREIGN KEY(product_id) REFERENCES products(id)
-        );
-    """)
-
     # Seed products only if table is empty
     count = cur.execute("SELECT COUNT(*) AS c FROM products;").fetchone()["c"]
     if count == 0:
@@ -112,24 +186,179 @@ def init_db():
             ("Cauliflower-1 Pc", 55, "img/cauliflower.jpg"),
             ("Lemon-6 Pc", 30, "img/lemon.jpg"),
         ]
-        cur.executemany(
-            "INSERT INTO products (name, price, image) VALUES (?, ?, ?);",
-            products
+        # Single multi-row INSERT instead of one bind/step per product
+        cur.execute(
+            "INSERT INTO products (name, price, image) VALUES "
+            + ", ".join(["(?, ?, ?)"] * len(products)) + ";",
+            list(chain.from_iterable(products))
         )
+        invalidate_products_cache()
 
+    # Refresh sqlite_stat1 so the planner picks the indexes above
+    cur.execute("ANALYZE;")
     db.commit()
 
+# ---------------- SQL ----------------
+# Hot-path statements live here so every call passes the same SQL text and
+# hits the pooled connections' prepared-statement cache. Cart reads carry
+# the cart total on every row (window SUM) instead of summing in Python.
+# The cart page and checkout page share SQL_CART_FETCH, so both are served
+# by one prepared statement.
+SQL_CART_FETCH = """
+    SELECT c.product_id, p.name, p.price, p.image, c.quantity,
+           (p.price * c.quantity) AS subtotal,
+           SUM(p.price * c.quantity) OVER () AS grand_total
+    FROM cart c
+    JOIN products p ON p.id = c.product_id
+    WHERE c.user_id = ?
+    ORDER BY p.name;
+"""
+
+SQL_CART_UPSERT = """
+    INSERT INTO cart (user_id, product_id, quantity)
+    VALUES (?, ?, 1)
+    ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = quantity + 1;
+"""
+
+# Both return the affected row id (or nothing), so no-op saves skip the commit
+SQL_CART_SET_QTY = """
+    UPDATE cart SET quantity=?
+    WHERE user_id=? AND product_id=? AND quantity<>?
+    RETURNING id;
+"""
+
+SQL_CART_REMOVE = "DELETE FROM cart WHERE user_id=? AND product_id=? RETURNING id;"
+
+SQL_CART_CLEAR = "DELETE FROM cart WHERE user_id=?;"
+
+SQL_CHECKOUT_TOTAL = """
+    SELECT COUNT(*) AS n, COALESCE(SUM(p.price * c.quantity), 0) AS total
+    FROM cart c JOIN products p ON p.id = c.product_id
+    WHERE c.user_id=?;
+"""
+
+SQL_ORDER_INSERT = "INSERT INTO orders (user_id, total_amount) VALUES (?, ?);"
+
+# Copies the cart straight into order_items without a Python round trip
+SQL_ORDER_ITEMS_INSERT = """
+    INSERT INTO order_items (order_id, product_id, quantity, price_each)
+    SELECT ?, c.product_id, c.quantity, p.price
+    FROM cart c JOIN products p ON p.id = c.product_id
+    WHERE c.user_id=?;
+"""
+
+# ---------------- Products cache ----------------
+# Products only change via init_db/migrations, so keep the rows and the
+# pre-serialized /api/products body in-process. The cache is rebuilt in
+# locals and published with a single assignment, so concurrent requests
+# never see a half-filled entry.
+_PRODUCTS_CACHE = None
+
+# Returns one consistent {"rows", "json", "etag"} entry; callers should read
+# every field from the same snapshot.
+def products_snapshot():
+    global _PRODUCTS_CACHE
+    cache = _PRODUCTS_CACHE
+    if cache is None:
+        rows = get_db().execute(
+            "SELECT id, name, price, image FROM products ORDER BY id;"
+        ).fetchall()
+        body = orjson.dumps(
+            [{"id": r[0], "name": r[1], "price": r[2], "image": r[3]} for r in rows]
+        )
+        cache = {
+            "rows": rows,
+            "json": body,
+            "etag": hashlib.blake2b(body, digest_size=8).hexdigest(),
+        }
+        _PRODUCTS_CACHE = cache
+    return cache
+
+def get_products():
+    return products_snapshot()["rows"]
+
+def invalidate_products_cache():
+    # Call from any route that mutates the products table
+    global _PRODUCTS_CACHE
+    _PRODUCTS_CACHE = None
+
 # ---------------- Auth helpers ----------------
+# Argon2id with a fixed cost, so each login costs the same CPU regardless
+# of the password.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+# Verified against when the username doesn't exist, so unknown users cost
+# the same as a wrong password and can't be told apart by timing.
+_DUMMY_HASH = password_hasher.hash("apna-cart-dummy-password")
+
+def check_password(stored_hash, password):
+    try:
+        return password_hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def authenticate(db, username, password):
+    user = db.execute(
+        "SELECT id, username, password FROM users WHERE username=?",
+        (username,)
+    ).fetchone()
+    if user is None:
+        check_password(_DUMMY_HASH, password)
+        return None
+
+    stored = user["password"]
+    if stored.startswith("$argon2"):
+        if not check_password(stored, password):
+            return None
+        needs_rehash = password_hasher.check_needs_rehash(stored)
+    else:
+        # Plaintext row from before passwords were hashed: accept it once
+        # and upgrade it to an Argon2 hash below.
+        check_password(_DUMMY_HASH, password)
+        if not hmac.compare_digest(stored.encode(), password.encode()):
+            return None
+        needs_rehash = True
+
+    if needs_rehash:
+        db.execute(
+            "UPDATE users SET password=? WHERE id=?",
+            (password_hasher.hash(password), user["id"])
+        )
+        db.commit()
+    return user
+
 def current_user_id():
     return session.get("user_id")
 
+# Both decorators read the session once and stash the id in g.uid
+def login_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        g.uid = current_user_id()
+        if not g.uid:
+            return redirect(url_for("login"))
+        return view(*args, **kwargs)
+    return wrapped
+
+def api_login_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        g.uid = current_user_id()
+        if not g.uid:
+            return jsonify({"ok": False, "redirect": url_for("login")}), 401
+        return view(*args, **kwargs)
+    return wrapped
+
 # ---------------- Routes ----------------
+# Under gunicorn the __main__ block below never runs, so make sure the
+# schema exists before the first request each worker serves.
+@app.before_request
+def ensure_db():
+    init_db()
+
 @app.route("/")
 def home():
-    db = get_db()
-    products = db.execute(
-        "SELECT id, name, price, image FROM products ORDER BY id;"
-    ).fetchall()
+    products = get_products()
     return render_template("index.html", products=products)
 
 @app.route("/signup", methods=["GET", "POST"])
@@ -147,7 +376,7 @@ def signup():
             db = get_db()
             db.execute(
                 "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-                (username, email, password)  # Note: hash in real apps
+                (username, email, password_hasher.hash(password))
             )
             db.commit()
             flash("Signup successful. Please log in.", "success")
@@ -164,11 +393,7 @@ def login():
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "").strip()
 
-        db = get_db()
-        user = db.execute(
-            "SELECT id, username FROM users WHERE username=? AND password=?",
-            (username, password)
-        ).fetchone()
+        user = authenticate(get_db(), username, password)
 
         if user:
             session["user_id"] = user["id"]
@@ -188,117 +413,90 @@ def logout():
     return redirect(url_for("home"))
 
 @app.route("/cart")
+@login_required
 def cart():
-    if not current_user_id():
-        return redirect(url_for("login"))
     db = get_db()
-    items = db.execute("""
-        SELECT c.product_id, p.name, p.price, p.image, c.quantity,
-               (p.price * c.quantity) AS subtotal
-        FROM cart c
-        JOIN products p ON p.id = c.product_id
-        WHERE c.user_id = ?
-        ORDER BY p.name;
-    """, (current_user_id(),)).fetchall()
-
-    total = sum(row["subtotal"] for row in items) if items else 0
+    items = db.execute(SQL_CART_FETCH, (g.uid,)).fetchall()
+
+    total = items[0]["grand_total"] if items else 0
     return render_template("cart.html", items=items, total=total)
 
 @app.post("/cart/add/<int:product_id>")
+@api_login_required
 def add_to_cart(product_id: int):
-    if not current_user_id():
-        return jsonify({"ok": False, "redirect": url_for("login")}), 401
-
     db = get_db()
-    row = db.execute(
-        "SELECT quantity FROM cart WHERE user_id=? AND product_id=?;",
-        (current_user_id(), product_id)
-    ).fetchone()
-    if row:
-        db.execute("""
-            UPDATE cart SET quantity = quantity + 1
-            WHERE user_id=? AND product_id=?;
-        """, (current_user_id(), product_id))
-    else:
-        db.execute("""
-            INSERT INTO cart (user_id, product_id, quantity)
-            VALUES (?, ?, 1);
-        """, (current_user_id(), product_id))
+    try:
+        db.execute(SQL_CART_UPSERT, (g.uid, product_id))
+    except sqlite3.IntegrityError:
+        # Foreign keys are enforced: either the product doesn't exist or the
+        # session points at a user that no longer does.
+        db.rollback()
+        if db.execute("SELECT 1 FROM products WHERE id=?;", (product_id,)).fetchone():
+            session.clear()
+            return jsonify({"ok": False, "redirect": url_for("login")}), 401
+        return jsonify({"ok": False, "error": "Unknown product."}), 404
     db.commit()
     return jsonify({"ok": True})
 
 @app.post("/cart/update/<int:product_id>")
+@api_login_required
 def update_cart(product_id: int):
-    if not current_user_id():
-        return jsonify({"ok": False, "redirect": url_for("login")}), 401
-
     qty = int(request.form.get("quantity", 1))
     qty = max(0, qty)
     db = get_db()
 
     if qty == 0:
-        db.execute(
-            "DELETE FROM cart WHERE user_id=? AND product_id=?;",
-            (current_user_id(), product_id)
-        )
+        changed = db.execute(SQL_CART_REMOVE, (g.uid, product_id)).fetchone()
     else:
-        db.execute("""
-            UPDATE cart SET quantity=? WHERE user_id=? AND product_id=?;
-        """, (qty, current_user_id(), product_id))
-    db.commit()
+        changed = db.execute(SQL_CART_SET_QTY, (qty, g.uid, product_id, qty)).fetchone()
+
+    if changed:
+        db.commit()
+    else:
+        # Nothing changed (e.g. UI re-submitted the same qty); skip the fsync
+        db.rollback()
     return jsonify({"ok": True})
 
 @app.post("/cart/clear")
+@api_login_required
 def clear_cart():
-    if not current_user_id():
-        return jsonify({"ok": False}), 401
     db = get_db()
-    db.execute("DELETE FROM cart WHERE user_id=?;", (current_user_id(),))
+    db.execute(SQL_CART_CLEAR, (g.uid,))
     db.commit()
     return jsonify({"ok": True})
 
 @app.route("/checkout", methods=["GET", "POST"])
+@login_required
 def checkout():
-    if not current_user_id():
-        return redirect(url_for("login"))
-
     db = get_db()
     if request.method == "POST":
-        items = db.execute("""
-            SELECT c.product_id, p.price, c.quantity
-            FROM cart c JOIN products p ON p.id = c.product_id
-            WHERE c.user_id=?;
-        """, (current_user_id(),)).fetchall()
-
-        if not items:
-            flash("Cart is empty.", "error")
-            return redirect(url_for("cart"))
+        # One write transaction for the whole order; IMMEDIATE takes the
+        # write lock up-front so the cart DELETE can't hit SQLITE_BUSY.
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            summary = db.execute(SQL_CHECKOUT_TOTAL, (g.uid,)).fetchone()
 
-        total = sum(i["price"] * i["quantity"] for i in items)
+            if not summary["n"]:
+                db.rollback()
+                flash("Cart is empty.", "error")
+                return redirect(url_for("cart"))
 
-        cur = db.cursor()
-        cur.execute(
-            "INSERT INTO orders (user_id, total_amount) VALUES (?, ?);",
-            (current_user_id(), total)
-        )
-        order_id = cur.lastrowid
+            cur = db.cursor()
+            cur.execute(SQL_ORDER_INSERT, (g.uid, summary["total"]))
+            order_id = cur.lastrowid
 
-        cur.executemany("""
-            INSERT INTO order_items (order_id, product_id, quantity, price_each)
-            VALUES (?, ?, ?, ?);
-        """, [(order_id, i["product_id"], i["quantity"], i["price"]) for i in items])
+            cur.execute(SQL_ORDER_ITEMS_INSERT, (order_id, g.uid))
 
-        cur.execute("DELETE FROM cart WHERE user_id=?;", (current_user_id(),))
-        db.commit()
+            cur.execute(SQL_CART_CLEAR, (g.uid,))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
 
         return redirect(url_for("thank_you", order_id=order_id))
 
-    items = db.execute("""
-        SELECT p.name, p.price, c.quantity, (p.price*c.quantity) AS subtotal
-        FROM cart c JOIN products p ON p.id = c.product_id
-        WHERE c.user_id=?;
-    """, (current_user_id(),)).fetchall()
-    total = sum(row["subtotal"] for row in items) if items else 0
+    items = db.execute(SQL_CART_FETCH, (g.uid,)).fetchall()
+    total = items[0]["grand_total"] if items else 0
     return render_template("checkout.html", items=items, total=total)
 
 @app.route("/thank-you/<int:order_id>")
@@ -319,11 +517,13 @@ def pay():
 
 @app.get("/api/products")
 def api_products():
-    db = get_db()
-    rows = db.execute(
-        "SELECT id, name, price, image FROM products ORDER BY id;"
-    ).fetchall()
-    return jsonify([dict(r) for r in rows])
+    snapshot = products_snapshot()
+    resp = Response(snapshot["json"], mimetype="application/json")
+    resp.set_etag(snapshot["etag"])
+    resp.cache_control.max_age = 300
+    # Werkzeug does the weak If-None-Match comparison (proxies like nginx's
+    # gzip weaken ETags) and strips the body on 304
+    return resp.make_conditional(request)
 
 # ---------------- Entry ----------------
 if __name__ == "__main__":
@@ -333,4 +533,5 @@ if __name__ == "__main__":
             os.makedirs(BASE_DIR, exist_ok=True)
         init_db()
 
-    app.run(debug=True)
+    # Dev server only; in production run under gunicorn (see README)
+    app.run(debug=os.environ.get("FLASK_ENV") == "development")